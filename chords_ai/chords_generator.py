@@ -8,7 +8,7 @@ from chords_ai.player import ChordSequencePlayer
 
 import os
 from keras import models
-from keras.preprocessing.sequence import pad_sequences
+import tensorflow as tf
 import json
 import numpy as np
 
@@ -27,27 +27,50 @@ class ChordsAI(object):
             # Load user-provided model
             assert os.path.exists(model_file), "Provided model file %s does not exist" % model_file
 
-        # Actually load the Keras model
+        # Actually load the Keras model. We only use it for inference, so there is no need to restore the optimizer
+        # and compile the training graph
         self._model = models.load_model(model_file,
                                   custom_objects={
-                                      'sparse_top_k_categorical_accuracy_3': sparse_top_k_categorical_accuracy_3})
+                                      'sparse_top_k_categorical_accuracy_3': sparse_top_k_categorical_accuracy_3},
+                                  compile=False)
 
         # Get the length of the sequences from the first layer (the Embedding layer)
         self._seq_length = self._model.layers[0].input_shape[1]
 
+        # Inference function, traced once for sequences of integers of the right length (so that it is never
+        # re-traced during the generation)
+        self._infer = tf.function(lambda x: self._model(x, training=False),
+                                  input_signature=[tf.TensorSpec((None, self._seq_length), tf.int32)])
+
+        # Traced function that also samples the next chord of each sequence, so that only one integer per sequence
+        # (instead of the full vector of probabilities) needs to be transferred out of the graph at each step
+        self._infer_and_sample = tf.function(self._sample_next_chords,
+                                             input_signature=[tf.TensorSpec((None, self._seq_length), tf.int32),
+                                                              tf.TensorSpec((), tf.float32)])
+
         # Now read in the vocabulary
         with open(get_path_of_data_file("best_songs_vocabulary.json")) as f:
 
             self._vocabulary = json.load(f)
 
-        # Sort alphabetically to make sure that the order is correct
-        # (we did this before training the network)
-        self._vocabulary = sorted(self._vocabulary)
+        # The order must be alphabetical (we did this before training the network). The vocabulary file is written
+        # already sorted, so we only sort it if that is not the case (checking is cheaper than sorting)
+        if any(a > b for a, b in zip(self._vocabulary[:-1], self._vocabulary[1:])):
+
+            self._vocabulary = sorted(self._vocabulary)
 
         # Prepare the mapping from chord to integer, and the inverse mapping as well
         self._mapping = {k: v for k, v in zip(self._vocabulary, range(len(self._vocabulary)))}
         self._inverse_mapping = {v: k for k, v in zip(self._vocabulary, range(len(self._vocabulary)))}
 
+        # Since the indexes are dense (0 ... len(vocabulary) - 1) and the vocabulary is sorted, the vocabulary itself
+        # is a lookup table from integer to chord. Indexing a list is cheaper than hashing the numpy integers
+        # returned by the network
+        self._inverse_list = self._vocabulary
+
+        # The vocabulary as a numpy array, used to encode chords in bulk (see _encode)
+        self._vocab_arr = np.array(self._vocabulary)
+
     def model_summary(self):
         """
         Summarize the model
@@ -85,16 +108,60 @@ class ChordsAI(object):
         """
         return self._seq_length
 
+    def _sample_next_chords(self, x, temperature):
+        """
+        Sample the next chord for each sequence in x with the Gumbel-max trick: adding Gumbel noise to the
+        log-probabilities and taking the argmax is equivalent to sampling from the (temperature-scaled) distribution
+
+        :param x: tensor of encoded sequences, with shape (n_sequences, seq_length)
+        :param temperature: the log-probabilities are divided by this number before sampling
+        :return: tensor of int32 with shape (n_sequences,)
+        """
+
+        # The network outputs probabilities, so their log are the logits (up to an irrelevant constant)
+        logits = tf.math.log(self._model(x, training=False)) / temperature
+
+        # Avoid 0 in the uniform deviates, which would give an infinite noise
+        u = tf.random.uniform(tf.shape(logits), minval=np.finfo(np.float32).tiny, maxval=1.0)
+        g = -tf.math.log(-tf.math.log(u))
+
+        return tf.argmax(logits + g, axis=-1, output_type=tf.int32)
+
+    def _encode(self, tokens):
+        """
+        Encode chords as integers. Since the vocabulary is sorted, this is a vectorized binary search, equivalent
+        to (but faster than) looking up each chord in the mapping
+
+        :param tokens: a list (or array) of chords, or a list of lists of chords of the same length
+        :return: np.array of int32 with the same shape as tokens
+        """
+
+        tokens = np.asarray(tokens)
+
+        idx = np.searchsorted(self._vocab_arr, tokens)
+
+        # Chords not in the vocabulary end up next to where they would be, so make sure we found the real ones
+        # (clipping first so that chords past the end of the vocabulary do not make the indexing fail)
+        found = self._vocab_arr[np.minimum(idx, len(self._vocab_arr) - 1)] == tokens
+
+        if not np.all(found):
+
+            raise KeyError("Chords not in vocabulary: %s" % ", ".join(sorted(set(tokens[~found]))))
+
+        return idx.astype(np.int32)
+
     def generate_random_sequence(self, n_chords_to_generate, play=False):
 
         # Get n_chords_to_generate random integers between 0 and the length of the vocabulary
         idx = np.random.randint(0, len(self._vocabulary), n_chords_to_generate)
 
-        final_sequence = " ".join(map(lambda x:self._inverse_mapping[x], idx))
+        final_sequence = " ".join(map(lambda x: self._inverse_list[x], idx))
 
         if play:
 
-            audio = ChordSequencePlayer().play(final_sequence)
+            with ChordSequencePlayer() as p:
+
+                audio = p.play(final_sequence)
 
         else:
 
@@ -111,45 +178,57 @@ class ChordsAI(object):
         assert len(chord_sequence) == self.length_of_sequences, \
             "You need to provide an input sequence of chords of length %s" % self.length_of_sequences
 
-        # generate a fixed number of characters
-        for _ in range(n_chords_to_generate):
+        # encode the seed chords as integers, once. This buffer always contains the last "seq_length" chords
+        # and is shifted by one at each iteration, so we never need to re-encode nor pad the sequence
+        buf = np.empty((1, self.length_of_sequences), dtype=np.int32)
+        buf[0, :] = self._encode(chord_sequence)
 
-            # encode the characters as integers
-            encoded = [self._mapping[ch] for ch in chord_sequence]
+        # The generated chords are kept as integers, and translated back to chords only at the end
+        out_ints = np.empty(n_chords_to_generate, dtype=np.int32)
 
-            # truncate sequence to the last "seq_length" chords
-            pad_encoded = pad_sequences([encoded], maxlen=self.length_of_sequences, truncating='pre')
+        # Buffer for the cumulative distribution used when sampling
+        cdf = np.empty(len(self._vocabulary), dtype=np.float64)
+
+        # generate a fixed number of characters
+        for i in range(n_chords_to_generate):
 
             # get predictions from network
             # Remember: this is a vector of probabilities (one probability for each element of the vocabulary)
-            preds = self._model.predict(pad_encoded, verbose=0)[0]
+            # NOTE: we call the traced model directly instead of using .predict(), which has a large per-call
+            # overhead (callbacks, batching machinery...) that dominates the cost for a batch of one
+            preds = self._infer(buf).numpy()[0]
 
             if probabilistic:
 
-                # Pick one chord randomly, according to the probabilities
-                yhat = np.random.choice(range(len(self.vocabulary)),
-                                        p=preds)
+                # Pick one chord randomly, according to the probabilities, by inverting the cumulative
+                # distribution. Scaling the uniform deviate by the last element of the CDF protects us from
+                # probabilities summing to slightly less than 1 because of rounding
+                np.cumsum(preds, out=cdf)
+                yhat = int(np.searchsorted(cdf, np.random.random() * cdf[-1], side='right'))
 
             else:
 
                 # Just get the most probable
-                yhat = preds.argmax()
+                yhat = int(preds.argmax())
 
-            # reverse map integer to character
-            out_char = self._inverse_mapping[yhat]
+            out_ints[i] = yhat
 
-            # append to input so that in the next iteration the memory of the previous chords
-            # will be passed to the network
-            chord_sequence.append(out_char)
+            # shift the buffer and append the new chord, so that in the next iteration the memory of the
+            # previous chords will be passed to the network
+            buf[0, :-1] = buf[0, 1:]
+            buf[0, -1] = yhat
+
+        # reverse map integers to chords and append them to the input sequence (i.e., the "song")
+        chord_sequence.extend(self._inverse_list[yhat] for yhat in out_ints)
 
-        # Generate sequence with generated chords and input sequence (i.e., the "song")
         complete_sequence_str = " ".join(chord_sequence)
 
         if play:
 
             # We generate a player for this sequence
-            p = ChordSequencePlayer()
-            audio = p.play(complete_sequence_str)
+            with ChordSequencePlayer() as p:
+
+                audio = p.play(complete_sequence_str)
 
         else:
 
@@ -160,3 +239,47 @@ class ChordsAI(object):
 
         return complete_sequence_str, audio
 
+    def generate_batch(self, seed_chord_sequences, n_chords_to_generate, temperature=1.0):
+        """
+        Generate several sequences at once, one for each seed. The sequences are independent, but the network is
+        evaluated on all of them together, which is much faster than calling generate_seq once for each seed
+
+        :param seed_chord_sequences: list of strings, each containing a space-separated sequence of chords of length
+        length_of_sequences
+        :param n_chords_to_generate: number of chords to generate for each seed
+        :param temperature: the log-probabilities predicted by the network are divided by temperature before
+        sampling. Values lower than 1 make the generation more conservative, values larger than 1 more adventurous
+        :return: list of strings, each containing the seed followed by the generated chords
+        """
+
+        assert temperature > 0, "The temperature must be positive"
+
+        # Split input sequences into lists
+        chord_sequences = [seed.split() for seed in seed_chord_sequences]
+
+        for chord_sequence in chord_sequences:
+
+            assert len(chord_sequence) == self.length_of_sequences, \
+                "You need to provide input sequences of chords of length %s" % self.length_of_sequences
+
+        # encode the seeds as integers, once. Each row of this buffer always contains the last "seq_length" chords
+        # of the corresponding sequence
+        buf = self._encode(chord_sequences).reshape(len(chord_sequences), self.length_of_sequences)
+
+        out_ints = np.empty((len(chord_sequences), n_chords_to_generate), dtype=np.int32)
+
+        for i in range(n_chords_to_generate):
+
+            # run the network on all the sequences at once and pick one chord randomly for each of them, according
+            # to the probabilities (this is done within the graph, so we only get back one integer per sequence)
+            yhat = self._infer_and_sample(buf, np.float32(temperature)).numpy()
+
+            out_ints[:, i] = yhat
+
+            # shift the buffer and append the new chords
+            buf[:, :-1] = buf[:, 1:]
+            buf[:, -1] = yhat
+
+        # reverse map integers to chords and append them to the seeds
+        return [" ".join(chord_sequence + [self._inverse_list[yhat] for yhat in this_out])
+                for chord_sequence, this_out in zip(chord_sequences, out_ints)]
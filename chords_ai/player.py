@@ -13,24 +13,78 @@ from chords_ai.package_data import get_path_of_data_file
 
 class ChordSequencePlayer(object):
 
-    def __init__(self, rate=44100):
+    def __init__(self, rate=44100, instrument=None):
 
         # Read dictionary containing chord components
         with open(get_path_of_data_file("chords_components.yml")) as f:
 
             self._components = yaml.load(f)
 
+        # Translate once and for all the notes making up each chord into their equivalent MIDI integer numbers
+        self._midi_table = {chord: np.array([lazy_midi.str2midi("%s5" % x) for x in notes], dtype=np.int32)
+                            for chord, notes in self._components.items()}
+
         self._rate = rate
 
-    def play(self, seq, instrument=None):
+        # Cache of the waveforms already synthetized, keyed by (chord, instrument). Chord sequences are very
+        # repetitive, so this saves most of the synthesis work
+        self._chord_cache = {}
+
+        # Default instrument for this player (None means the default piano sound font)
+        self._instrument = instrument
+
+        # The synthetizer is opened lazily the first time we need it, and kept open (together with the sound fonts
+        # loaded in it, keyed by path) until close() is called, because loading a sound font is expensive
+        self._fl = None
+        self._sfids = {}
+
+    def __enter__(self):
+
+        return self
+
+    def __exit__(self, *args):
+
+        self.close()
+
+    def __del__(self):
+
+        # fluidsynth.Synth does not free the native synthetizer when garbage-collected, so we need to do it here for
+        # players that have not been closed explicitly (the check protects against a failure in __init__)
+        if getattr(self, "_fl", None) is not None:
+
+            self.close()
+
+    def close(self):
+        """
+        Close the synthetizer (if open). The player can still be used afterwards, and a new synthetizer will be
+        opened if needed
+
+        :return: None
+        """
+
+        if self._fl is not None:
+
+            self._fl.delete()
+
+            self._fl = None
+            self._sfids = {}
+
+    def play(self, seq, instrument=None, display_audio=True):
         """
         Play sequence of chords
 
         :param seq: a string containing a space-separated sequence of chords
-        :param instrument: user-supplied sf2 sound font (do not set it to use default)
-        :return: None
+        :param instrument: user-supplied sf2 sound font (do not set it to use the one provided to the constructor,
+        or the default)
+        :param display_audio: whether to display an audio player (in a Jupyter notebook). Set it to False if you
+        only need the waveform, to avoid the cost of encoding it
+        :return: np.array containing the waveform
         """
 
+        if instrument is None:
+
+            instrument = self._instrument
+
         if instrument is None:
 
             # Use default sound font
@@ -38,46 +92,72 @@ class ChordSequencePlayer(object):
 
         seq = str(seq)
 
-        audio = []
+        chords = seq.split(" ")
 
-        for chord in seq.split(" "):
-            audio = np.append(audio, self._make_chord(chord, instrument))
+        # Synthetize the chords we have not seen yet
+        for chord in set(chords):
 
-        display(Audio(audio, rate=self._rate, autoplay=False))
+            if (chord, instrument) not in self._chord_cache:
+
+                self._chord_cache[(chord, instrument)] = self._make_chord(chord, instrument)
+
+        # Concatenate all the waveforms at once (np.append in a loop would copy the whole buffer at each step)
+        audio = np.concatenate([self._chord_cache[(chord, instrument)] for chord in chords])
+
+        if display_audio:
+
+            display(Audio(audio, rate=self._rate, autoplay=False))
 
         return audio
 
+    def _get_synth(self, instrument):
+        """
+        Return the synthetizer and the id of the given sound font, opening the former and loading the latter if
+        this has not been done already
+
+        :param instrument: path to the sf2 sound font
+        :return: (fluidsynth.Synth instance, sound font id)
+        """
+
+        if self._fl is None:
+
+            self._fl = fluidsynth.Synth(self._rate)
+
+        if instrument not in self._sfids:
+
+            self._sfids[instrument] = self._fl.sfload(instrument)
+
+        return self._fl, self._sfids[instrument]
+
     def _make_chord(self, chord, instrument):
         """
         Make a waveform with the notes of the given chord
 
         :param chord: name of the chord
+        :param instrument: path to the sf2 sound font
         :return: np.array containing the waveform
         """
 
-        # Get notes making up the chord
-        components = self._components[chord]
+        fl, sfid = self._get_synth(instrument)
 
-        # Get the equivalent MIDI integer number
-        midi_notes = map(lambda x: lazy_midi.str2midi("%s5" % x), components)
+        # Get the MIDI integer numbers of the notes making up the chord
+        midi_notes = self._midi_table[chord]
 
-        # Open synthetizer and load instrument (sound font)
-        fl = fluidsynth.Synth(self._rate)
-        sfid = fl.sfload(instrument)
+        # Start from a clean synthetizer (no tails from the previous chord) and select the instrument
+        fl.system_reset()
         fl.program_select(0, sfid, 0, 0)
 
         # Play each note of the chord
         for note in midi_notes:
-            fl.noteon(0, note, 60)
+            fl.noteon(0, int(note), 60)
 
-        # Record what the synth is playing into a numpy array
-        s = np.array(fl.get_samples(self._rate), float)
+        # Record what the synth is playing into a numpy array. Single precision is plenty for 16-bit PCM samples
+        # and halves the memory we need to move around when concatenating and encoding the audio
+        s = np.asarray(fl.get_samples(self._rate), dtype=np.float32)
 
-        # Stop all notes and close synthetizer
+        # Stop all notes
         for note in midi_notes:
-            fl.noteoff(0, note)
-
-        fl.delete()
+            fl.noteoff(0, int(note))
 
         # Return numpy array
-        return s
\ No newline at end of file
+        return s
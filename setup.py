@@ -19,6 +19,7 @@ setup(
             'pandas',
             'matplotlib',
             'keras',
+            'tensorflow',
             'scikit-learn',
             'ipython',
             'audiolazy',